@@ -1,3 +1,4 @@
+import itertools
 import pickle
 
 file_path = './Dink-Net/data/ind.cora.graph'
@@ -5,6 +6,13 @@ file_path = './Dink-Net/data/ind.cora.graph'
 with open(file_path, 'rb') as f:
     graph_data = pickle.load(f)
 
-# Previewing the first 5 items
-for node, neighbors in list(graph_data.items())[:5]:
+# Previewing the first 5 items. CSR graphs store the neighbours of node i
+# as indices[indptr[i]:indptr[i + 1]]; older graphs are a dict of lists.
+if 'indptr' in graph_data:
+    indptr, indices = graph_data['indptr'], graph_data['indices']
+    preview = ((node, indices[indptr[node]:indptr[node + 1]].tolist())
+               for node in range(len(indptr) - 1) if indptr[node + 1] > indptr[node])
+else:
+    preview = iter(graph_data.items())
+for node, neighbors in itertools.islice(preview, 5):
     print(f'Node {node} neighbors: {neighbors}')
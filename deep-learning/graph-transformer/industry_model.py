@@ -6,21 +6,44 @@ class IndustryClassifier:
     def __init__(
         self,
         ner_model="dslim/bert-base-NER",
-        classifier_model="facebook/bart-large-mnli"
+        classifier_model="facebook/bart-large-mnli",
+        quantize=True  # Dynamic int8 Linear layers when running on CPU
     ):
+        # Run on the GPU in half precision when available; FP16 is not worth it on CPU
+        use_cuda = torch.cuda.is_available()
+        device = 0 if use_cuda else -1
+        torch_dtype = torch.float16 if use_cuda else torch.float32
+        
         # Initialize pipelines
         self.ner_pipeline = pipeline(
             "ner",
             model=ner_model,
             tokenizer=ner_model,
-            aggregation_strategy="simple"  # Groups tokens into whole entities
+            aggregation_strategy="simple",  # Groups tokens into whole entities
+            device=device,
+            torch_dtype=torch_dtype
         )
         
         self.zero_shot_pipeline = pipeline(
             "zero-shot-classification",
-            model=classifier_model
+            model=classifier_model,
+            device=device,
+            torch_dtype=torch_dtype
         )
         
+        # Fuse the attention/GEMM kernels of both models on the GPU; on CPU, run
+        # their Linear layers as int8 GEMMs with dynamically quantized activations
+        if use_cuda:
+            self.ner_pipeline.model = torch.compile(self.ner_pipeline.model, dynamic=True)
+            self.zero_shot_pipeline.model = torch.compile(self.zero_shot_pipeline.model, dynamic=True)
+        elif quantize:
+            self.ner_pipeline.model = torch.ao.quantization.quantize_dynamic(
+                self.ner_pipeline.model, {nn.Linear}, dtype=torch.qint8
+            )
+            self.zero_shot_pipeline.model = torch.ao.quantization.quantize_dynamic(
+                self.zero_shot_pipeline.model, {nn.Linear}, dtype=torch.qint8
+            )
+        
         # Define classification labels
         self.startup_labels = [
             "early-stage startup",
@@ -38,48 +61,77 @@ class IndustryClassifier:
             "Crypto",
             "Academia"
         ]
+        
+        # Both label sets are scored in a single zero-shot call
+        self.candidate_labels = self.startup_labels + self.industry_labels
+
+    @staticmethod
+    def _top_label(scores, labels):
+        """
+        Returns the highest-scoring label in labels and its score renormalized over labels.
+        """
+        best_label = max(labels, key=scores.get)
+        return best_label, scores[best_label] / sum(scores[label] for label in labels)
 
     def predict_industry(self, text):
         """
         Predicts company type and industry from text description.
+        Also accepts a list of texts, which are run through the pipelines as one
+        batch and return a list of predictions.
         """
-        # Extract organizations via NER
-        entities = self.ner_pipeline(text)
-        org_entities = [ent["word"] for ent in entities if ent["entity_group"] == "ORG"]
+        single_text = isinstance(text, str)
+        texts = [text] if single_text else list(text)
         
-        if not org_entities:
-            org_entities = ["(No explicit company found)"]
+        # Extract organizations via NER
+        all_entities = self.ner_pipeline(texts, batch_size=len(texts))
         
-        # Classify startup vs established
-        startup_result = self.zero_shot_pipeline(text, self.startup_labels)
-        startup_prediction = startup_result["labels"][0]
-        startup_confidence = startup_result["scores"][0]
+        # Score all candidate labels in one batched call. Single-label scores are a
+        # softmax over the candidates, so renormalizing within each label set gives
+        # the same result as classifying the two sets separately.
+        results = self.zero_shot_pipeline(
+            texts,
+            self.candidate_labels,
+            batch_size=len(self.candidate_labels)
+        )
         
-        # Classify industry
-        industry_result = self.zero_shot_pipeline(text, self.industry_labels)
-        industry_prediction = industry_result["labels"][0]
-        industry_confidence = industry_result["scores"][0]
+        predictions = []
+        for text, entities, result in zip(texts, all_entities, results):
+            org_entities = [ent["word"] for ent in entities if ent["entity_group"] == "ORG"]
+            
+            if not org_entities:
+                org_entities = ["(No explicit company found)"]
+            
+            scores = dict(zip(result["labels"], result["scores"]))
+            
+            # Classify startup vs established
+            startup_prediction, startup_confidence = self._top_label(scores, self.startup_labels)
+            
+            # Classify industry
+            industry_prediction, industry_confidence = self._top_label(scores, self.industry_labels)
+            
+            predictions.append({
+                "text": text,
+                "detected_orgs": org_entities,
+                "startup_or_not": {
+                    "label": startup_prediction,
+                    "confidence": startup_confidence
+                },
+                "industry": {
+                    "label": industry_prediction,
+                    "confidence": industry_confidence
+                }
+            })
         
-        return {
-            "text": text,
-            "detected_orgs": org_entities,
-            "startup_or_not": {
-                "label": startup_prediction,
-                "confidence": startup_confidence
-            },
-            "industry": {
-                "label": industry_prediction,
-                "confidence": industry_confidence
-            }
-        }
+        return predictions[0] if single_text else predictions
 
-def create_industry_pipeline(ner_model=None, classifier_model=None):
+def create_industry_pipeline(ner_model=None, classifier_model=None, quantize=True):
     """
     Creates a pipeline for industry/company classification
     """
     classifier = IndustryClassifier(
         ner_model=ner_model if ner_model else "dslim/bert-base-NER",
-        classifier_model=classifier_model if classifier_model else "facebook/bart-large-mnli"
+        classifier_model=classifier_model if classifier_model else "facebook/bart-large-mnli",
+        quantize=quantize
     )
     
     def predict(text):
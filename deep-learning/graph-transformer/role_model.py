@@ -1,9 +1,39 @@
+import hashlib
+import os
+import platform
+from collections import OrderedDict
+from functools import lru_cache
+
 import torch
 import torch.nn as nn
 from transformers import AutoTokenizer, AutoModelForSequenceClassification
 from torch_geometric.nn import TransformerConv
 from torch_geometric.nn import global_mean_pool
-from torch_geometric.utils import to_dense_adj, dense_to_sparse
+from torch_geometric.utils import coalesce
+
+
+def _configure_cpu():
+    """
+    Sizes the CPU thread pools for small-batch inference. The intra-op pool
+    defaults to every logical core, which oversubscribes hyperthreaded CPUs;
+    MERCOR_CPU_THREADS overrides the physical-core estimate.
+    """
+    num_threads = int(os.environ.get("MERCOR_CPU_THREADS", 0)) or max(1, (os.cpu_count() or 2) // 2)
+    torch.set_num_threads(num_threads)
+    try:
+        torch.set_num_interop_threads(1)
+    except RuntimeError:
+        # Only settable before the first inter-op parallel work in the process
+        pass
+
+
+_configure_cpu()
+
+@torch.jit.script
+def norm_residual(x: torch.Tensor, x_res: torch.Tensor, weight: torch.Tensor, bias: torch.Tensor, eps: float) -> torch.Tensor:
+    # LayerNorm then an in-place residual add on its output, so the sum needs no extra buffer
+    return torch.layer_norm(x, x.shape[-1:], weight, bias, eps).add_(x_res)
+
 
 class GraphTransformer(nn.Module):
     def __init__(self, dim, depth, edge_dim):
@@ -23,29 +53,16 @@ class GraphTransformer(nn.Module):
         # Layer norm
         self.norm = nn.LayerNorm(dim)
 
-    def forward(self, x, adj_mat):
-        # Remove batch dimension for processing
-        x = x.squeeze(0)
-        adj_mat = adj_mat.squeeze(0)
-        
-        # Convert adjacency matrix to edge index
-        edge_index, _ = dense_to_sparse(adj_mat)
-        
+    def forward(self, x: torch.Tensor, edge_index: torch.Tensor) -> torch.Tensor:
+        # x: [num_nodes, dim], edge_index: [2, num_edges]
         # Store residual
         x_res = x
         
         # Apply transformer layer
         x = self.transformer(x, edge_index)
         
-        # Apply normalization
-        x = self.norm(x)
-        
-        # Add residual
-        x = x + x_res
-        
-        # Add batch dimension back
-        x = x.unsqueeze(0)
-        return x
+        # Apply normalization and add residual
+        return norm_residual(x, x_res, self.norm.weight, self.norm.bias, self.norm.eps)
 
 class CareerGraphModel(nn.Module):
     def __init__(
@@ -56,50 +73,207 @@ class CareerGraphModel(nn.Module):
         depth=3,
         career_model_name="fazni/distilbert-base-uncased-career-path-prediction",
         text_weight=0.8,  # Even higher weight for text
-        graph_weight=0.2  # Lower weight for graph
+        graph_weight=0.2,  # Lower weight for graph
+        text_cache_size=16384,  # Max number of texts whose logits are kept
+        graph_cache_size=8,  # Max number of graphs whose logits are kept
+        precision="fp16"  # BERT autocast dtype on CUDA: "fp16", "bf16" or "fp32"
     ):
         super().__init__()
         self.text_weight = text_weight
         self.graph_weight = graph_weight
         
+        autocast_dtypes = {"fp16": torch.float16, "bf16": torch.bfloat16, "fp32": None}
+        if precision not in autocast_dtypes:
+            raise ValueError(f"Unsupported precision {precision!r}; expected one of {list(autocast_dtypes)}")
+        self.autocast_dtype = autocast_dtypes[precision]
+        
         # Career prediction components (primary signal)
-        self.career_tokenizer = AutoTokenizer.from_pretrained(career_model_name)
+        self.career_tokenizer = AutoTokenizer.from_pretrained(career_model_name, use_fast=True)
         self.career_model = AutoModelForSequenceClassification.from_pretrained(career_model_name)
         
         # Graph components (supplementary signal)
         self.input_proj = nn.Linear(input_dim, model_dim)
-        self.transformer = GraphTransformer(
+        # Scripted so the norm/residual ops run without Python dispatch per call
+        self.transformer = torch.jit.script(GraphTransformer(
             dim=model_dim,
             depth=depth,
             edge_dim=edge_dim
-        )
+        ))
         self.graph_proj = nn.Linear(model_dim, self.career_model.config.num_labels)
+        
+        # Tokenizer outputs for repeated texts are served from an LRU cache
+        self._tokenize_cached = lru_cache(maxsize=1024)(self._tokenize)
+        
+        # Career model logits per text (LRU), reused while the text branch is frozen
+        self.text_cache_size = text_cache_size
+        self._text_cache = OrderedDict()
+        
+        # Graph branch logits per graph (LRU); graph_data is usually fixed across text queries
+        self.graph_cache_size = graph_cache_size
+        self._graph_cache = OrderedDict()
+        
+        # CUDA side stream the graph branch runs on, created on first use
+        self._graph_stream = None
 
-    def forward(self, graph_data, text_data):
-        # Get text predictions (primary signal)
+    def _tokenize(self, text_data):
         text_inputs = self.career_tokenizer(
-            text_data,
+            text_data if isinstance(text_data, str) else list(text_data),
             padding=True,
             truncation=True,
             return_tensors="pt",
             max_length=512
-        ).to(graph_data.x.device)
+        )
+        # Pinned host memory lets the copy to the GPU run asynchronously
+        if torch.cuda.is_available():
+            return {key: value.pin_memory() for key, value in text_inputs.items()}
+        return dict(text_inputs)
+
+    def tokenize_text(self, text_data, device):
+        """
+        Tokenizes a text (or list of texts) and moves it to device,
+        reusing the cached CPU tensors when the same input was seen before.
+        """
+        cache_key = text_data if isinstance(text_data, str) else tuple(text_data)
+        text_inputs = self._tokenize_cached(cache_key)
+        return {key: value.to(device, non_blocking=True) for key, value in text_inputs.items()}
+
+    @staticmethod
+    def _text_key(text):
+        return hashlib.blake2b(text.encode("utf-8"), digest_size=16).hexdigest()
+
+    def encode_text(self, text_data, device):
+        """
+        Returns the career model logits for a text (or list of texts).
+        In eval mode with gradients disabled the logits are cached per text,
+        so repeated texts skip tokenization and the BERT forward pass.
+        """
+        if self.career_model.training or torch.is_grad_enabled():
+            text_inputs = self.tokenize_text(text_data, device)
+            return self._career_logits(text_inputs, device)
+        
+        texts = [text_data] if isinstance(text_data, str) else list(text_data)
+        keys = [self._text_key(text) for text in texts]
+        missing = list(dict.fromkeys(
+            text for text, key in zip(texts, keys) if key not in self._text_cache
+        ))
+        if missing:
+            text_inputs = self.tokenize_text(missing, device)
+            for text, logits in zip(missing, self._career_logits(text_inputs, device)):
+                self._text_cache[self._text_key(text)] = logits
+        # Entries may live on another device (e.g. loaded from disk on CPU), so each
+        # is moved before stacking
+        text_logits = torch.stack([self._text_cache[key].to(device) for key in keys])
         
-        # Get BERT predictions
-        text_outputs = self.career_model(**text_inputs)
-        text_logits = text_outputs.logits
+        for key in keys:
+            self._text_cache.move_to_end(key)
+        self._trim_text_cache()
+        return text_logits
+
+    def _trim_text_cache(self):
+        while len(self._text_cache) > self.text_cache_size:
+            self._text_cache.popitem(last=False)
+
+    def _career_logits(self, text_inputs, device):
+        # On CUDA the BERT matmuls run in half precision on tensor cores;
+        # the logits are returned in FP32 to combine with the graph branch
+        use_autocast = device.type == "cuda" and self.autocast_dtype is not None
+        with torch.autocast(device_type=device.type, dtype=self.autocast_dtype, enabled=use_autocast):
+            logits = self.career_model(**text_inputs).logits
+        return logits.float()
+
+    def _graph_logits(self, graph_data):
+        x = self.input_proj(graph_data.x)
         
-        # Process graph data (supplementary signal)
-        x = graph_data.x
-        adj = to_dense_adj(graph_data.edge_index)[0]
-        x = self.input_proj(x)
-        x = x.unsqueeze(0)
-        adj = adj.unsqueeze(0)
+        # Get graph features. TransformerConv works on the sparse edge_index directly;
+        # coalescing drops duplicate edges, as the old dense adjacency round-trip did.
+        edge_index = coalesce(graph_data.edge_index, num_nodes=graph_data.num_nodes)
+        graph_features = self.transformer(x, edge_index)
+        return self.graph_proj(graph_features.mean(dim=0))
+
+    def encode_graph(self, graph_data):
+        """
+        Returns the graph branch logits for graph_data.
+        In eval mode with gradients disabled the logits are cached per graph,
+        so repeated queries against the same graph skip the transformer.
+        """
+        if self.training or torch.is_grad_enabled():
+            return self._graph_logits(graph_data)
         
-        # Get graph features
-        graph_features = self.transformer(x, adj)
-        graph_features = graph_features.squeeze(0)
-        graph_logits = self.graph_proj(graph_features.mean(dim=0))
+        x, edge_index = graph_data.x, graph_data.edge_index
+        # Inference tensors have no version counter, so in-place edits to them
+        # could not be detected; those graphs are not cached.
+        if x.is_inference() or edge_index.is_inference():
+            return self._graph_logits(graph_data)
+        # The entry holds on to x and edge_index, so their storage cannot be reused
+        # by another graph; the version counters catch in-place edits.
+        key = (x.data_ptr(), x._version, edge_index.data_ptr(), edge_index._version, graph_data.num_nodes)
+        if key not in self._graph_cache:
+            self._graph_cache[key] = (x, edge_index, self._graph_logits(graph_data))
+        self._graph_cache.move_to_end(key)
+        while len(self._graph_cache) > self.graph_cache_size:
+            self._graph_cache.popitem(last=False)
+        return self._graph_cache[key][2]
+
+    def save_text_cache(self, path):
+        """
+        Saves the cached text logits so a later run with the same weights can reuse them.
+        """
+        torch.save({key: logits.cpu() for key, logits in self._text_cache.items()}, path)
+
+    def load_text_cache(self, path):
+        self._text_cache.update(torch.load(path, weights_only=True))
+        self._trim_text_cache()
+
+    def train(self, mode=True):
+        # Cached logits are only valid for the weights they were computed with
+        if mode:
+            self._text_cache.clear()
+            self._graph_cache.clear()
+        return super().train(mode)
+
+    def load_state_dict(self, state_dict, *args, **kwargs):
+        self._text_cache.clear()
+        self._graph_cache.clear()
+        return super().load_state_dict(state_dict, *args, **kwargs)
+
+    def quantize_text_model(self):
+        """
+        Swaps the career model's Linear layers for dynamically quantized int8 ones
+        (FBGEMM/oneDNN on x86, QNNPACK on ARM). CPU inference only; call it after
+        loading weights, since checkpoints hold the FP32 layers.
+        """
+        if platform.machine().lower() in ("arm64", "aarch64"):
+            torch.backends.quantized.engine = "qnnpack"
+        self.career_model.eval()
+        self.career_model = torch.ao.quantization.quantize_dynamic(
+            self.career_model, {nn.Linear}, dtype=torch.qint8
+        )
+        self._text_cache.clear()
+
+    def forward(self, graph_data, text_data):
+        device = graph_data.x.device
+        
+        # A branch whose weight is zero is skipped entirely rather than computed and scaled away
+        if self.graph_weight == 0:
+            # Text predictions only (primary signal) from BERT
+            text_logits = self.encode_text(text_data, device)
+            return (self.text_weight * text_logits).squeeze(0)
+        
+        if self.text_weight == 0:
+            # Graph predictions only, one row per text like the text branch would give
+            graph_logits = self.graph_weight * self.encode_graph(graph_data)
+            if isinstance(text_data, str):
+                return graph_logits
+            return graph_logits.expand(len(text_data), -1)
+        
+        if device.type == "cuda":
+            text_logits, graph_logits = self._encode_overlapped(graph_data, text_data, device)
+        else:
+            # Get text predictions (primary signal) from BERT
+            text_logits = self.encode_text(text_data, device)
+            
+            # Process graph data (supplementary signal)
+            graph_logits = self.encode_graph(graph_data)
         
         # Weighted combination of predictions
         combined_logits = (
@@ -109,31 +283,74 @@ class CareerGraphModel(nn.Module):
         
         return combined_logits.squeeze(0)
 
+    def _encode_overlapped(self, graph_data, text_data, device):
+        """
+        Runs the graph branch on a side stream while the text inputs are copied
+        (from pinned memory, non-blocking) and BERT runs on the current stream.
+        """
+        current_stream = torch.cuda.current_stream(device)
+        if self._graph_stream is None or self._graph_stream.device != device:
+            self._graph_stream = torch.cuda.Stream(device)
+        self._graph_stream.wait_stream(current_stream)
+        with torch.cuda.stream(self._graph_stream):
+            graph_logits = self.encode_graph(graph_data)
+        
+        text_logits = self.encode_text(text_data, device)
+        
+        current_stream.wait_stream(self._graph_stream)
+        # graph_logits was allocated on the side stream but is consumed on this one
+        graph_logits.record_stream(current_stream)
+        return text_logits, graph_logits
+
     def predict_career_path(self, graph_data, text_data):
         self.eval()
-        with torch.no_grad():
+        with torch.inference_mode():
             predictions = self(graph_data, text_data)
             probabilities = torch.softmax(predictions, dim=-1)
             
             # Get top 3 predictions
             top_probs, top_indices = torch.topk(probabilities, k=3)
             
-            predictions = []
-            for prob, idx in zip(top_probs, top_indices):
-                predictions.append({
-                    'label': self.career_model.config.id2label[idx.item()],
-                    'score': prob.item()
-                })
+            id2label = self.career_model.config.id2label
+            return [
+                {'label': id2label[idx], 'score': prob}
+                for prob, idx in zip(top_probs.tolist(), top_indices.tolist())
+            ]
+
+    def predict_career_path_batch(self, graph_data, text_data_list):
+        """
+        Predicts the top 3 career paths for each text, running all texts through
+        the model in a single batched forward pass.
+        """
+        self.eval()
+        with torch.inference_mode():
+            predictions = self(graph_data, list(text_data_list))
+            probabilities = torch.softmax(predictions, dim=-1).reshape(len(text_data_list), -1)
             
-            return predictions
+            # Get top 3 predictions per text
+            top_probs, top_indices = torch.topk(probabilities, k=3, dim=-1)
+            
+            id2label = self.career_model.config.id2label
+            return [
+                [{'label': id2label[idx], 'score': prob} for prob, idx in zip(row_probs, row_indices)]
+                for row_probs, row_indices in zip(top_probs.tolist(), top_indices.tolist())
+            ]
 
-def create_career_pipeline(model_path=None):
+def create_career_pipeline(model_path=None, quantize=True):
     model = CareerGraphModel()
     if model_path:
         model.load_state_dict(torch.load(model_path))
     
+    # The pipeline runs on CPU, where int8 dynamic quantization speeds up BERT
+    if quantize:
+        model.quantize_text_model()
+    
+    @torch.inference_mode()
     def predict(graph_data, text_data):
-        return model.predict_career_path(graph_data, text_data)
+        # A list of texts is predicted in one batched forward pass
+        if isinstance(text_data, str):
+            return model.predict_career_path(graph_data, text_data)
+        return model.predict_career_path_batch(graph_data, text_data)
     
     return predict
 
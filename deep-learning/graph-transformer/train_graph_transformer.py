@@ -25,9 +25,12 @@ import torch.distributed as dist
 from torch.nn.parallel import DistributedDataParallel as DDP
 
 from torch_geometric.data import Data, InMemoryDataset
-from torch_geometric.utils import to_dense_adj
+from torch_geometric.nn import TransformerConv
+from torch_geometric.utils import coalesce, to_dense_adj
 import numpy as np
 import pickle
+from scipy import sparse
+from safetensors.torch import load_file, save_file
 
 # Import the GraphTransformer model from lucidrains package.
 from graph_transformer_pytorch import GraphTransformer
@@ -54,6 +57,21 @@ def is_main_process():
     return not dist.is_initialized() or dist.get_rank() == 0
 
 
+def load_raw_array(path):
+    """
+    Load an ind.<name>.* feature/label file. convert_data.py writes dense arrays
+    as .npy and sparse matrices as .npz; older raw directories contain pickles.
+    """
+    with open(path, 'rb') as f:
+        magic = f.read(6)
+        f.seek(0)
+        if magic == b'\x93NUMPY':
+            return np.load(f)
+        if magic.startswith(b'PK'):
+            return sparse.load_npz(f)
+        return pickle.load(f)
+
+
 class CloutDataset(InMemoryDataset):
     def __init__(self, root, name='clout', transform=None, pre_transform=None):
         self.name = name
@@ -63,13 +81,12 @@ class CloutDataset(InMemoryDataset):
         
         # Check if processed file exists
         processed_path = self.processed_paths[0]
-        if os.path.exists(processed_path):
-            # Explicitly use weights_only=False to allow loading torch_geometric classes
-            self.data, self.slices = torch.load(processed_path, weights_only=False)
-        else:
+        if not os.path.exists(processed_path):
             # This will trigger the process() method to run
             self.process()
-            self.data, self.slices = torch.load(self.processed_paths[0], weights_only=False)
+        # The processed file is a flat safetensors archive of the graph's tensors:
+        # memory-mapped on load and free of pickled code
+        self.data, self.slices = self.collate([Data(**load_file(processed_path))])
 
     @property
     def raw_file_names(self):
@@ -79,7 +96,7 @@ class CloutDataset(InMemoryDataset):
 
     @property
     def processed_file_names(self):
-        return ['data.pt']
+        return ['data.safetensors']
 
     def download(self):
         # No download required, data already in raw_dir
@@ -89,38 +106,40 @@ class CloutDataset(InMemoryDataset):
         data_path = self.raw_dir
         
         # Load features and labels
-        with open(os.path.join(data_path, f'ind.{self.name}.allx'), 'rb') as f:
-            allx = pickle.load(f)
-        with open(os.path.join(data_path, f'ind.{self.name}.ally'), 'rb') as f:
-            ally = pickle.load(f)
+        allx = load_raw_array(os.path.join(data_path, f'ind.{self.name}.allx'))
+        ally = load_raw_array(os.path.join(data_path, f'ind.{self.name}.ally'))
             
         # Load graph structure
         with open(os.path.join(data_path, f'ind.{self.name}.graph'), 'rb') as f:
             graph_dict = pickle.load(f)
             
-        # Convert graph_dict to edge_index
-        edge_index = []
-        for source, targets in graph_dict.items():
-            for target in targets:
-                edge_index.append([source, target])
+        # Convert graph_dict to edge_index. convert_data.py stores the adjacency as
+        # CSR indptr/indices arrays; older raw directories hold a dict of lists.
+        # Either way the result is a [2, num_edges] tensor in PyG format.
+        if 'indptr' in graph_dict:
+            indptr = torch.as_tensor(graph_dict['indptr'], dtype=torch.long)
+            sources = torch.repeat_interleave(torch.arange(indptr.numel() - 1), indptr.diff())
+            targets = torch.as_tensor(graph_dict['indices'], dtype=torch.long)
+            edge_index = torch.stack([sources, targets])
+        else:
+            sources = torch.tensor([source for source, targets in graph_dict.items() for _ in targets], dtype=torch.long)
+            targets = torch.tensor([target for targets in graph_dict.values() for target in targets], dtype=torch.long)
+            edge_index = torch.stack([sources, targets])
                 
-        if not edge_index:  # If empty, create a default self-loop
+        if not edge_index.size(1):  # If empty, create a default self-loop
             print("Warning: No edges found in graph. Creating self-loop for first node.")
-            edge_index = [[0, 0]]
+            edge_index = torch.zeros((2, 1), dtype=torch.long)
             
         # Create masks for train/val/test
         num_nodes = allx.shape[0]
-        train_mask = torch.zeros(num_nodes, dtype=torch.bool)
         val_mask = torch.zeros(num_nodes, dtype=torch.bool)
         test_mask = torch.zeros(num_nodes, dtype=torch.bool)
         
         # Load test indices if file exists
         try:
             with open(os.path.join(data_path, f'ind.{self.name}.test.index'), 'r') as f:
-                test_indices = [int(idx) for idx in f.readlines()]
-                for idx in test_indices:
-                    if 0 <= idx < num_nodes:
-                        test_mask[idx] = True
+                test_indices = torch.tensor([int(idx) for idx in f.readlines()], dtype=torch.long)
+                test_mask[test_indices[(test_indices >= 0) & (test_indices < num_nodes)]] = True
         except (FileNotFoundError, IOError):
             # If no test indices, use last 20% of nodes for testing
             test_size = int(0.2 * num_nodes)
@@ -133,15 +152,12 @@ class CloutDataset(InMemoryDataset):
             print(f"No valid test indices found, using last {test_size} nodes as test set")
         
         # Use 15% for validation (from non-test nodes)
-        non_test_indices = [i for i in range(num_nodes) if not test_mask[i]]
-        val_size = min(int(0.15 * num_nodes), len(non_test_indices))
-        for idx in non_test_indices[:val_size]:
-            val_mask[idx] = True
+        non_test_indices = (~test_mask).nonzero(as_tuple=True)[0]
+        val_size = min(int(0.15 * num_nodes), non_test_indices.numel())
+        val_mask[non_test_indices[:val_size]] = True
             
         # Remaining nodes (non-test, non-val) are for training
-        for i in range(num_nodes):
-            if not (test_mask[i] or val_mask[i]):
-                train_mask[i] = True
+        train_mask = ~(test_mask | val_mask)
                 
         # Convert sparse matrices to tensors if needed
         if hasattr(allx, 'toarray'):
@@ -158,9 +174,6 @@ class CloutDataset(InMemoryDataset):
         if y.dim() > 1 and y.size(1) > 1:
             y = y.max(1)[1]
             
-        # Create edge_index tensor (PyG format)
-        edge_index = torch.tensor(edge_index, dtype=torch.long).t().contiguous()
-        
         # Create the data object
         data = Data(
             x=x,
@@ -171,9 +184,7 @@ class CloutDataset(InMemoryDataset):
             test_mask=test_mask
         )
         
-        data_list = [data]
-        data, slices = self.collate(data_list)
-        torch.save((data, slices), self.processed_paths[0])
+        save_file({key: value.contiguous() for key, value in data.items()}, self.processed_paths[0])
 
 
 class ModelWrapper(nn.Module):
@@ -219,6 +230,62 @@ class ModelWrapper(nn.Module):
         return logits
 
 
+class SparseModelWrapper(nn.Module):
+    """
+    Same interface as ModelWrapper, but attends only along graph edges.
+    
+    A stack of PyG TransformerConv layers consumes the [2, num_edges] edge_index
+    directly, so no [num_nodes, num_nodes] adjacency (or per-pair edge embedding)
+    is ever materialized and memory grows with the edge count instead.
+    """
+    def __init__(self, input_dim, model_dim, depth, num_classes, heads=8):
+        super().__init__()
+        self.input_proj = nn.Linear(input_dim, model_dim)
+        self.layers = nn.ModuleList([
+            TransformerConv(model_dim, model_dim, heads=heads, concat=False, dropout=0.1)
+            for _ in range(depth)
+        ])
+        self.norms = nn.ModuleList([nn.LayerNorm(model_dim) for _ in range(depth)])
+        self.classifier = nn.Linear(model_dim, num_classes)
+
+    def forward(self, x, edge_index, mask):
+        # x: [num_nodes, input_dim], edge_index: [2, num_edges]
+        # mask is accepted for interface parity; every node is attended to via its edges.
+        x = self.input_proj(x)  # [num_nodes, model_dim]
+        for conv, norm in zip(self.layers, self.norms):
+            x = x + norm(conv(x, edge_index))
+        logits = self.classifier(x)  # [num_nodes, num_classes]
+        return logits
+
+
+def capture_train_step(model, optimizer, criterion, x, graph_input, mask, train_idx, y_train, warmup_iters=3):
+    """
+    Capture one forward/backward training step into a CUDA graph.
+    
+    The inputs are used as the graph's static buffers, so replaying the graph
+    recomputes the logits and loss and refills the .grad tensors in place; the
+    caller only has to run optimizer.step() after each replay. The warmup iterations run on
+    a side stream and leave the weights untouched.
+    """
+    stream = torch.cuda.Stream()
+    stream.wait_stream(torch.cuda.current_stream())
+    with torch.cuda.stream(stream):
+        for _ in range(warmup_iters):
+            optimizer.zero_grad(set_to_none=True)
+            loss = criterion(model(x, graph_input, mask).index_select(0, train_idx), y_train)
+            loss.backward()
+    torch.cuda.current_stream().wait_stream(stream)
+    
+    # Grads must be allocated inside the graph's memory pool so replays overwrite them
+    optimizer.zero_grad(set_to_none=True)
+    graph = torch.cuda.CUDAGraph()
+    with torch.cuda.graph(graph):
+        static_logits = model(x, graph_input, mask)
+        static_loss = criterion(static_logits.index_select(0, train_idx), y_train)
+        static_loss.backward()
+    return graph, static_logits, static_loss
+
+
 def train(args, device, use_ddp=True):
     print("Processing...")
     
@@ -226,21 +293,31 @@ def train(args, device, use_ddp=True):
     dataset = CloutDataset(root=args.data_dir, name=args.dataset)
     data = dataset[0].to(device)
     
-    # Create a dense adjacency matrix from edge_index.
-    # to_dense_adj returns a tensor of shape [1, num_nodes, num_nodes]
-    adj = to_dense_adj(data.edge_index, max_num_nodes=data.num_nodes)[0].to(device)
-    
     # For transformer input mask we use all-ones (all nodes valid)
     full_mask = torch.ones(data.num_nodes, dtype=torch.bool, device=device)
     
     # Initialize our model wrapper.
-    model = ModelWrapper(
-        input_dim=dataset.num_features,
-        model_dim=args.model_dim,
-        edge_dim=args.edge_dim,
-        depth=args.depth,
-        num_classes=dataset.num_classes
-    ).to(device)
+    if args.sparse:
+        # Edge-wise attention on the edge_index itself: O(E) memory instead of O(N^2).
+        # Coalescing drops duplicate edges, as the dense adjacency would.
+        graph_input = coalesce(data.edge_index, num_nodes=data.num_nodes)
+        model = SparseModelWrapper(
+            input_dim=dataset.num_features,
+            model_dim=args.model_dim,
+            depth=args.depth,
+            num_classes=dataset.num_classes
+        ).to(device)
+    else:
+        # Create a dense adjacency matrix from edge_index.
+        # to_dense_adj returns a tensor of shape [1, num_nodes, num_nodes]
+        graph_input = to_dense_adj(data.edge_index, max_num_nodes=data.num_nodes)[0].to(device)
+        model = ModelWrapper(
+            input_dim=dataset.num_features,
+            model_dim=args.model_dim,
+            edge_dim=args.edge_dim,
+            depth=args.depth,
+            num_classes=dataset.num_classes
+        ).to(device)
     
     # Optionally wrap the model in DDP if not running on macOS.
     if use_ddp:
@@ -250,37 +327,67 @@ def train(args, device, use_ddp=True):
         else:
             model = DDP(model)
     
+    if args.compile:
+        # TF32 matmuls on Ampere/Hopper; reduce-overhead fuses the elementwise ops and
+        # replays the compiled graphs through CUDA graphs itself
+        torch.set_float32_matmul_precision('high')
+        model = torch.compile(model, mode='reduce-overhead', fullgraph=False)
+    
     optimizer = optim.Adam(model.parameters(), lr=args.lr)
     criterion = nn.CrossEntropyLoss()
     
     best_val_acc = 0.0
     best_test_acc = 0.0
     
-    for epoch in range(1, args.epochs + 1):
+    # The splits are fixed, so gather them by index once instead of scanning the
+    # boolean masks over all nodes every epoch.
+    train_idx = data.train_mask.nonzero(as_tuple=True)[0]
+    val_idx = data.val_mask.nonzero(as_tuple=True)[0]
+    test_idx = data.test_mask.nonzero(as_tuple=True)[0]
+    y_train = data.y.index_select(0, train_idx)
+    y_val = data.y.index_select(0, val_idx)
+    y_test = data.y.index_select(0, test_idx)
+    
+    # On CUDA the training step is captured once and replayed every epoch, which
+    # removes the per-op launch overhead that dominates small full-batch graphs.
+    train_graph = None
+    if device.type == "cuda" and args.cuda_graphs and not args.compile:
         model.train()
-        optimizer.zero_grad()
-        
-        # Forward pass: get logits for all nodes.
-        logits = model(data.x, adj, full_mask)  # [num_nodes, num_classes]
-        
-        # Compute loss on training nodes.
-        loss = criterion(logits[data.train_mask], data.y[data.train_mask])
-        loss.backward()
+        # DDP needs 11 eager iterations before capture to finish bucket setup
+        train_graph, static_logits, static_loss = capture_train_step(
+            model, optimizer, criterion, data.x, graph_input, full_mask, train_idx, y_train,
+            warmup_iters=11 if use_ddp else 3
+        )
+    
+    # One full-batch forward per epoch: its logits drive the training loss and,
+    # detached, the train/val/test accuracies (measured before this epoch's step).
+    model.train()
+    for epoch in range(1, args.epochs + 1):
+        if train_graph is not None:
+            train_graph.replay()
+            logits, loss = static_logits, static_loss
+        else:
+            optimizer.zero_grad()
+            
+            # Forward pass: get logits for all nodes.
+            logits = model(data.x, graph_input, full_mask)  # [num_nodes, num_classes]
+            
+            # Compute loss on training nodes.
+            loss = criterion(logits.index_select(0, train_idx), y_train)
+            loss.backward()
         optimizer.step()
         
-        # Evaluation (full-batch).
-        model.eval()
         with torch.no_grad():
-            logits = model(data.x, adj, full_mask)
+            logits = logits.detach()
             # Calculate accuracy on train, validation, and test sets.
-            train_pred = logits[data.train_mask].argmax(dim=1)
-            train_acc = (train_pred == data.y[data.train_mask]).float().mean().item()
+            train_pred = logits.index_select(0, train_idx).argmax(dim=1)
+            train_acc = (train_pred == y_train).float().mean().item()
             
-            val_pred = logits[data.val_mask].argmax(dim=1)
-            val_acc = (val_pred == data.y[data.val_mask]).float().mean().item()
+            val_pred = logits.index_select(0, val_idx).argmax(dim=1)
+            val_acc = (val_pred == y_val).float().mean().item()
             
-            test_pred = logits[data.test_mask].argmax(dim=1)
-            test_acc = (test_pred == data.y[data.test_mask]).float().mean().item()
+            test_pred = logits.index_select(0, test_idx).argmax(dim=1)
+            test_acc = (test_pred == y_test).float().mean().item()
         
         if is_main_process() and epoch % args.print_every == 0:
             print(f"Epoch {epoch:03d}: Loss {loss.item():.4f}, "
@@ -318,6 +425,12 @@ def main():
                         help="Print training info every n epochs")
     parser.add_argument("--macos", action="store_true",
                         help="Run on macOS (CPU only, no distributed training)")
+    parser.add_argument("--sparse", action="store_true",
+                        help="Use edge_index-based TransformerConv layers instead of the dense-adjacency GraphTransformer")
+    parser.add_argument("--compile", action="store_true",
+                        help="torch.compile the model (reduce-overhead mode) and allow TF32 matmuls")
+    parser.add_argument("--cuda_graphs", action="store_true",
+                        help="Replay a captured CUDA graph for the training step instead of running it eagerly")
     args = parser.parse_args()
 
     # Select device and distributed mode based on the --macos flag.
@@ -326,6 +439,9 @@ def main():
         device = torch.device("cpu")
         use_ddp = False
     else:
+        if args.cuda_graphs and not args.compile:
+            # NCCL's async error watchdog is incompatible with graph-captured collectives
+            os.environ.setdefault("TORCH_NCCL_ASYNC_ERROR_HANDLING", "0")
         local_rank = setup_distributed()
         device = torch.device(f"cuda:{local_rank}")
         use_ddp = True
@@ -1,16 +1,80 @@
 import os
+import asyncio
+import hashlib
+import mmap
 import threading
-import subprocess
 import shutil
 import logging
 import time
-from flask import Flask, request, jsonify
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
 import requests
-from flask_socketio import SocketIO
-import base64
+import uvicorn
+from socketio import ASGIApp, AsyncServer
+from socketio.exceptions import TimeoutError as AckTimeoutError
 
-app = Flask(__name__)
-socketio = SocketIO(app)
+try:
+    # Optional: libuv-based event loop (installed with uvicorn[standard] on Linux/macOS)
+    import uvloop
+except ImportError:
+    uvloop = None
+
+# Socket.IO runs as an ASGI app on an asyncio event loop (uvloop when installed),
+# so client I/O never waits on a worker thread
+sio = AsyncServer(async_mode='asgi')
+app = ASGIApp(sio)
+
+class PipelineEmitter:
+    """
+    Thread-side handle on the server: emit/call from the pipeline worker thread
+    are scheduled onto the server's event loop, which owns all client I/O.
+    """
+    def __init__(self, server):
+        self.server = server
+        self.loop = None
+        # Outstanding call_each calls per client, so a disconnect can cancel them
+        self.pending_calls = defaultdict(set)
+
+    def emit(self, event, data=None, to=None):
+        asyncio.run_coroutine_threadsafe(self.server.emit(event, data, to=to), self.loop)
+
+    def call(self, event, data=None, to=None, timeout=60):
+        future = asyncio.run_coroutine_threadsafe(
+            self.server.call(event, data, to=to, timeout=timeout), self.loop
+        )
+        return future.result()
+
+    def call_each(self, event, data, sids, timeout=60):
+        """
+        Calls every client in sids concurrently with the same payload object and
+        returns their acks (or the exception raised for that client), in order.
+        A call cancelled by cancel_calls yields asyncio.CancelledError.
+        """
+        async def call_all():
+            tasks = []
+            for sid in sids:
+                task = asyncio.ensure_future(self.server.call(event, data, to=sid, timeout=timeout))
+                self.pending_calls[sid].add(task)
+                task.add_done_callback(lambda t, sid=sid: self._forget_call(sid, t))
+                tasks.append(task)
+            return await asyncio.gather(*tasks, return_exceptions=True)
+        return asyncio.run_coroutine_threadsafe(call_all(), self.loop).result()
+
+    def _forget_call(self, sid, task):
+        calls = self.pending_calls.get(sid)
+        if calls is not None:
+            calls.discard(task)
+            if not calls:
+                del self.pending_calls[sid]
+
+    def cancel_calls(self, sid):
+        """
+        Cancels the client's outstanding call_each calls; must run on the server loop.
+        """
+        for task in list(self.pending_calls.pop(sid, ())):
+            task.cancel()
+
+emitter = PipelineEmitter(sio)
 
 # Set up logging
 logging.basicConfig(level=logging.INFO)
@@ -19,52 +83,159 @@ logger = logging.getLogger(__name__)
 # Global flag and lock to avoid overlapping training runs
 training_lock = threading.Lock()
 training_in_progress = False
+# Set while a pipeline run is queued on the executor but has not started yet
+training_pending = False
+
+# A single reusable worker thread runs the pipeline; extra triggers are rejected up front
+pipeline_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='train-pipeline')
+
+# Number of trailing subprocess output lines kept for the failure log
+LOG_TAIL_LINES = 50
+# Max bytes of subprocess output read, and forwarded to clients, per log event
+LOG_READ_SIZE = 1 << 16
+
+# The model is pushed to clients as raw binary chunks, each acked before the next is sent
+MODEL_CHUNK_SIZE = 1 << 20
+MODEL_CHUNK_ACK_TIMEOUT = 30
+
+# Session ids of the connected WebSocket clients
+connected_clients = set()
+
+async def stream_subprocess(command, step):
+    """
+    Runs command and forwards its combined stdout/stderr to the log and to
+    WebSocket clients as it is produced. Whatever lines are ready when the pipe
+    is read go out together in one event, newline-joined. Only the last
+    LOG_TAIL_LINES lines are kept in memory. Returns (returncode, tail).
+    """
+    process = await asyncio.create_subprocess_exec(
+        *command, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.STDOUT
+    )
+    tail = deque(maxlen=LOG_TAIL_LINES)
+
+    def forward(raw_lines):
+        # \r-terminated progress-bar updates count as lines; blank lines are dropped
+        lines = [raw.decode('utf-8', errors='replace').rstrip() for raw in raw_lines if raw.strip()]
+        if not lines:
+            return
+        tail.extend(lines)
+        for line in lines:
+            logger.info("[%s] %s", step, line)
+        emitter.emit('training_status', {'status': 'progress', 'step': step, 'log': "\n".join(lines)})
+
+    partial = b''
+    while True:
+        chunk = await process.stdout.read(LOG_READ_SIZE)
+        if not chunk:
+            break
+        *complete, partial = (partial + chunk).replace(b'\r', b'\n').split(b'\n')
+        forward(complete)
+    forward([partial])
+    return await process.wait(), tail
+
+def run_subprocess(command, step):
+    # Each call runs on the pipeline thread, so it gets its own event loop
+    loop = uvloop.new_event_loop() if uvloop is not None else asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(stream_subprocess(command, step))
+    finally:
+        loop.close()
+
+def map_model_file(path):
+    """
+    Maps the model file read-only, so the upload, the checksum and the client
+    broadcast all read the same page-cache pages instead of re-reading the file.
+    """
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        return mmap.mmap(fd, 0, access=mmap.ACCESS_READ)
+    finally:
+        # The mapping holds its own reference to the file
+        os.close(fd)
+
+def broadcast_model(model_buffer, filename):
+    """
+    Streams the mapped model to every connected client as binary 'model_chunk'
+    events, then sends 'model_done' with the size and SHA-256 of the bytes sent.
+    Each chunk is copied out of the mapping once and sent to all clients at the
+    same time; every client must ack a chunk before the next one goes out, and a
+    client that does not ack within MODEL_CHUNK_ACK_TIMEOUT is dropped from the transfer.
+    """
+    recipients = list(connected_clients)
+    size = len(model_buffer)
+    sha256 = hashlib.sha256(model_buffer).hexdigest()
+    for offset in range(0, size, MODEL_CHUNK_SIZE):
+        # Clients that disconnected mid-transfer would otherwise hold up every chunk until the ack timeout
+        recipients = [sid for sid in recipients if sid in connected_clients]
+        if not recipients:
+            break
+        chunk = model_buffer[offset:offset + MODEL_CHUNK_SIZE]
+        acks = emitter.call_each('model_chunk', chunk, recipients, timeout=MODEL_CHUNK_ACK_TIMEOUT)
+        for sid, ack in zip(list(recipients), acks):
+            if isinstance(ack, AckTimeoutError):
+                logger.warning("Client %s did not ack model chunk; dropping it from the transfer", sid)
+                recipients.remove(sid)
+            elif isinstance(ack, asyncio.CancelledError):
+                logger.info("Client %s disconnected during the model transfer", sid)
+                recipients.remove(sid)
+            elif isinstance(ack, Exception):
+                raise ack
+    recipients = [sid for sid in recipients if sid in connected_clients]
+    for sid in recipients:
+        emitter.emit('model_done', {'filename': filename, 'size': size, 'sha256': sha256}, to=sid)
+    return len(recipients)
 
 def run_training_pipeline():
     """
     Runs the entire pipeline: delete old data, pull new data using convert_data.py,
     trigger distributed training, and then send the trained model to a server.
     """
-    global training_in_progress
+    global training_in_progress, training_pending
+    model_buffer = None
     with training_lock:
+        training_pending = False
         if training_in_progress:
             logger.info("Training already in progress; skipping new trigger.")
-            socketio.emit('training_status', {'status': 'skipped', 'message': 'Training already in progress'})
+            emitter.emit('training_status', {'status': 'skipped', 'message': 'Training already in progress'})
             return
         training_in_progress = True
 
     try:
         logger.info("Starting training pipeline...")
-        socketio.emit('training_status', {'status': 'started', 'message': 'Training pipeline started'})
+        emitter.emit('training_status', {'status': 'started', 'message': 'Training pipeline started'})
 
-        # Step 1: Delete old data directory
+        # Step 1: Delete old data directory. It is renamed out of the way next to
+        # the new one and deleted on a background thread, so the pipeline goes on at once.
         data_dir = os.path.join("graph-transformer", "data", "clout", "raw")
         if os.path.exists(data_dir):
-            logger.info("Deleting old data directory: %s", data_dir)
-            shutil.rmtree(data_dir)
+            old_data_dir = f"{data_dir}.old-{time.time_ns()}"
+            logger.info("Deleting old data directory: %s (moved to %s)", data_dir, old_data_dir)
+            os.rename(data_dir, old_data_dir)
+            threading.Thread(
+                target=shutil.rmtree, args=(old_data_dir,), kwargs={'ignore_errors': True}, daemon=True
+            ).start()
         os.makedirs(data_dir, exist_ok=True)
-        socketio.emit('training_status', {'status': 'progress', 'step': 'data_cleanup', 'message': 'Old data deleted'})
+        emitter.emit('training_status', {'status': 'progress', 'step': 'data_cleanup', 'message': 'Old data deleted'})
 
-        # Step 2: Run convert_data.py to pull the latest data from Neo4j.
+        # Step 2: Run convert_data to pull the latest data from Neo4j.
+        # It runs in-process: after the first run its imports and Neo4j driver are warm.
         logger.info("Running data conversion using convert_data.py ...")
-        socketio.emit('training_status', {'status': 'progress', 'step': 'data_conversion', 'message': 'Starting data conversion'})
-        result = subprocess.run(
-            ["python", "convert_data.py"],
-            capture_output=True, text=True
-        )
-        if result.returncode != 0:
-            logger.error("Data conversion failed: %s", result.stderr)
-            socketio.emit('training_status', {'status': 'error', 'step': 'data_conversion', 'message': 'Data conversion failed'})
+        emitter.emit('training_status', {'status': 'progress', 'step': 'data_conversion', 'message': 'Starting data conversion'})
+        try:
+            from convert_data import run as convert_data_run
+            convert_data_run(output_dir=data_dir)
+        except Exception as e:
+            logger.exception("Data conversion failed: %s", e)
+            emitter.emit('training_status', {'status': 'error', 'step': 'data_conversion', 'message': 'Data conversion failed'})
             return
-        else:
-            logger.info("Data conversion completed:\n%s", result.stdout)
-            socketio.emit('training_status', {'status': 'progress', 'step': 'data_conversion', 'message': 'Data conversion completed'})
+        logger.info("Data conversion completed")
+        emitter.emit('training_status', {'status': 'progress', 'step': 'data_conversion', 'message': 'Data conversion completed'})
 
         # Step 3: Trigger training.
         # This assumes that you're on an Ubuntu node with 8 H100s and that your training
         # script (train_graph_transformer.py) is set up for DDP with torchrun.
         logger.info("Starting training with torchrun...")
-        socketio.emit('training_status', {'status': 'progress', 'step': 'training', 'message': 'Starting distributed training'})
+        emitter.emit('training_status', {'status': 'progress', 'step': 'training', 'message': 'Starting distributed training'})
         train_command = [
             "torchrun",
             "--nproc_per_node=8",
@@ -72,84 +243,101 @@ def run_training_pipeline():
             "--epochs", "200",
             "--lr", "0.01"
         ]
-        result = subprocess.run(train_command, capture_output=True, text=True)
-        if result.returncode != 0:
-            logger.error("Training failed: %s", result.stderr)
-            socketio.emit('training_status', {'status': 'error', 'step': 'training', 'message': 'Training failed'})
+        returncode, output_tail = run_subprocess(train_command, 'training')
+        if returncode != 0:
+            logger.error("Training failed:\n%s", "\n".join(output_tail))
+            emitter.emit('training_status', {'status': 'error', 'step': 'training', 'message': 'Training failed'})
             return
         else:
-            logger.info("Training completed:\n%s", result.stdout)
-            socketio.emit('training_status', {'status': 'progress', 'step': 'training', 'message': 'Training completed'})
+            logger.info("Training completed")
+            emitter.emit('training_status', {'status': 'progress', 'step': 'training', 'message': 'Training completed'})
 
         # Step 4: Expect that the training script saved the trained model.
         model_path = os.path.join("graph-transformer", "best_model.pt")
         if not os.path.exists(model_path):
             logger.error("Trained model file not found at %s", model_path)
-            socketio.emit('training_status', {'status': 'error', 'step': 'model_verification', 'message': 'Trained model not found'})
+            emitter.emit('training_status', {'status': 'error', 'step': 'model_verification', 'message': 'Trained model not found'})
             return
+        # Steps 5 and 6 share one read-only mapping of the model file
+        model_buffer = map_model_file(model_path)
 
         # Step 5: Send the model file to a remote server.
         model_server_url = os.getenv("MODEL_SERVER_URL", "http://localhost:5000/upload")
         logger.info("Sending the trained model to server at %s", model_server_url)
-        socketio.emit('training_status', {'status': 'progress', 'step': 'model_upload', 'message': 'Uploading model to server'})
-        with open(model_path, "rb") as model_file:
-            files = {'model': model_file}
-            response = requests.post(model_server_url, files=files)
-            if response.status_code == 200:
-                logger.info("Model successfully sent to the server.")
-                socketio.emit('training_status', {'status': 'progress', 'step': 'model_upload', 'message': 'Model successfully uploaded'})
-            else:
-                logger.error(
-                    "Failed to send model. Status code: %s, Response: %s",
-                    response.status_code, response.text
-                )
-                socketio.emit('training_status', {'status': 'error', 'step': 'model_upload', 'message': f'Failed to upload model: {response.status_code}'})
+        emitter.emit('training_status', {'status': 'progress', 'step': 'model_upload', 'message': 'Uploading model to server'})
+        # The mapping is file-like, so it is streamed as the raw request body in
+        # small blocks rather than being copied whole into a multipart body
+        headers = {
+            'Content-Type': 'application/octet-stream',
+            'Content-Length': str(len(model_buffer)),
+            'Content-Disposition': 'attachment; filename="best_model.pt"',
+        }
+        model_buffer.seek(0)
+        response = requests.post(model_server_url, data=model_buffer, headers=headers)
+        if response.status_code == 200:
+            logger.info("Model successfully sent to the server.")
+            emitter.emit('training_status', {'status': 'progress', 'step': 'model_upload', 'message': 'Model successfully uploaded'})
+        else:
+            logger.error(
+                "Failed to send model. Status code: %s, Response: %s",
+                response.status_code, response.text
+            )
+            emitter.emit('training_status', {'status': 'error', 'step': 'model_upload', 'message': f'Failed to upload model: {response.status_code}'})
 
         # Step 6: Also send the model directly to WebSocket clients
         try:
             logger.info("Sending model to connected WebSocket clients")
-            with open(model_path, "rb") as model_file:
-                model_data = model_file.read()
-                # Convert binary data to base64 for safe transmission
-                model_base64 = base64.b64encode(model_data).decode('utf-8')
-                socketio.emit('model_data', {
-                    'model_base64': model_base64,
-                    'filename': 'best_model.pt'
-                })
-                logger.info("Model sent to connected clients")
+            num_clients = broadcast_model(model_buffer, 'best_model.pt')
+            logger.info("Model sent to %d connected clients", num_clients)
         except Exception as e:
             logger.error("Failed to send model to WebSocket clients: %s", str(e))
-            socketio.emit('training_status', {'status': 'error', 'step': 'model_websocket_send', 'message': f'Failed to send model to clients: {str(e)}'})
+            emitter.emit('training_status', {'status': 'error', 'step': 'model_websocket_send', 'message': f'Failed to send model to clients: {str(e)}'})
 
-        socketio.emit('training_status', {'status': 'completed', 'message': 'Training pipeline completed successfully'})
+        emitter.emit('training_status', {'status': 'completed', 'message': 'Training pipeline completed successfully'})
 
     except Exception as e:
         logger.exception("Exception in training pipeline: %s", e)
-        socketio.emit('training_status', {'status': 'error', 'step': 'unknown', 'message': f'Exception: {str(e)}'})
+        emitter.emit('training_status', {'status': 'error', 'step': 'unknown', 'message': f'Exception: {str(e)}'})
     finally:
+        if model_buffer is not None:
+            model_buffer.close()
         with training_lock:
             training_in_progress = False
         logger.info("Training pipeline finished.")
 
-@socketio.on('connect')
-def handle_connect():
+@sio.on('connect')
+async def handle_connect(sid, environ):
     logger.info("Client connected")
+    connected_clients.add(sid)
     return {'status': 'connected'}
 
-@socketio.on('disconnect')
-def handle_disconnect():
+@sio.on('disconnect')
+async def handle_disconnect(sid, *args):
     logger.info("Client disconnected")
+    connected_clients.discard(sid)
+    # A model chunk still waiting on this client's ack would otherwise wait out the timeout
+    emitter.cancel_calls(sid)
 
-@socketio.on('data_update')
-def handle_data_update(data):
+@sio.on('data_update')
+async def handle_data_update(sid, data):
     """
     Handles 'data_update' events from WebSocket clients.
-    When received, triggers the training process in a background thread.
+    When received, triggers the training process on the pipeline worker thread,
+    unless a run is already queued or in progress.
     """
+    global training_pending
     logger.info("Received data_update event: %s", data)
     
-    # Run the training pipeline in a separate thread so the socket can return quickly
-    threading.Thread(target=run_training_pipeline).start()
+    with training_lock:
+        if training_in_progress or training_pending:
+            logger.info("Training already in progress; rejecting new trigger.")
+            return {'status': 'rejected', 'message': 'Training already in progress'}
+        training_pending = True
+    
+    # Run the training pipeline on the worker thread so the socket can return quickly;
+    # its emits are handed back to this loop
+    emitter.loop = asyncio.get_running_loop()
+    pipeline_executor.submit(run_training_pipeline)
     
     return {'status': 'accepted', 'message': 'Training triggered'}
 
@@ -157,4 +345,4 @@ if __name__ == "__main__":
     # Listen on port 3000 on all network interfaces
     port = 3000
     logger.info("Starting WebSocket server on port %s", port)
-    socketio.run(app, host="0.0.0.0", port=port, debug=False, allow_unsafe_werkzeug=True)
\ No newline at end of file
+    uvicorn.run(app, host="0.0.0.0", port=port, loop="auto")
\ No newline at end of file
@@ -1,14 +1,56 @@
 import os
 import pickle
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 import numpy as np
 import matplotlib.pyplot as plt
 from scipy import sparse
 import networkx as nx
+from sklearn.decomposition import TruncatedSVD
 from sklearn.manifold import TSNE
 
+try:
+    # Optional: Graphviz's multilevel sfdp layout (networkx needs pygraphviz for it)
+    import pygraphviz  # noqa: F401
+    from networkx.drawing.nx_agraph import graphviz_layout
+except ImportError:
+    graphviz_layout = None
+
+try:
+    # Optional: C-accelerated ForceAtlas2 layout for large graphs
+    from fa2_modified import ForceAtlas2
+except ImportError:
+    ForceAtlas2 = None
+
+try:
+    # Optional: multicore FFT-accelerated t-SNE
+    from openTSNE import TSNE as OpenTSNE
+except ImportError:
+    OpenTSNE = None
+
+# Sparse feature matrices wider than this are reduced with TruncatedSVD before t-SNE
+TSNE_SVD_COMPONENTS = 50
+
+# Graphs with more nodes than this are saved as GraphML and drawn as a plain node scatter
+LARGE_GRAPH_NODES = 50_000
+
+def load_array(path):
+    """
+    Load a feature/label file produced by convert_data.py. Dense arrays are
+    stored as .npy and are memory-mapped read-only rather than read into memory;
+    sparse matrices are stored as .npz; older files are pickles.
+    """
+    with open(path, "rb") as f:
+        magic = f.read(6)
+        f.seek(0)
+        if magic == b"\x93NUMPY":
+            return np.load(path, mmap_mode="r")
+        if magic.startswith(b"PK"):
+            return sparse.load_npz(f)
+        return pickle.load(f)
+
 def load_graph(data_dir):
     """
-    Load the graph (adjacency list) from the file produced by convert_data.py.
+    Load the graph adjacency from the file produced by convert_data.py.
     Expected file: ind.clout.graph
     """
     graph_filename = "ind.clout.graph"
@@ -17,75 +59,116 @@ def load_graph(data_dir):
         graph = pickle.load(f)
     return graph
 
-def load_train_features(data_dir):
+def load(data_dir, name):
     """
-    Load training features from file ind.clout.x.
+    Load features or labels from file ind.clout.<name>: x/y for training,
+    tx/ty for testing, allx/ally for all nodes.
     """
-    filename = "ind.clout.x"
+    filename = f"ind.clout.{name}"
     path = os.path.join(data_dir, filename)
-    with open(path, "rb") as f:
-        X = pickle.load(f)
-    return X
+    return load_array(path)
 
-def load_train_labels(data_dir):
+def graph_edges(graph):
     """
-    Load training labels from file ind.clout.y.
+    Return the (sources, targets) edge arrays of a loaded graph. convert_data.py
+    stores the adjacency as CSR indptr/indices arrays; older files hold a dict
+    mapping each node to its list of neighbours.
     """
-    filename = "ind.clout.y"
-    path = os.path.join(data_dir, filename)
-    with open(path, "rb") as f:
-        Y = pickle.load(f)
-    return Y
+    if "indptr" in graph:
+        indptr = np.asarray(graph["indptr"])
+        sources = np.repeat(np.arange(indptr.size - 1), np.diff(indptr))
+        return sources, np.asarray(graph["indices"])
+    # Size both arrays from the neighbour-list lengths, then fill targets in place
+    lens = np.fromiter(map(len, graph.values()), dtype=np.int64, count=len(graph))
+    offsets = np.concatenate(([0], np.cumsum(lens)))
+    sources = np.repeat(np.fromiter(graph.keys(), dtype=np.int64, count=len(graph)), lens)
+    targets = np.empty(offsets[-1], dtype=np.int64)
+    for start, end, neighbours in zip(offsets[:-1], offsets[1:], graph.values()):
+        targets[start:end] = np.fromiter(neighbours, dtype=np.int64, count=end - start)
+    return sources, targets
 
-def load_test_features(data_dir):
+def graph_adjacency(graph):
     """
-    Load testing features from file ind.clout.tx.
+    Return the graph as a sparse N x N CSR adjacency matrix (N = highest node id + 1).
     """
-    filename = "ind.clout.tx"
-    path = os.path.join(data_dir, filename)
-    with open(path, "rb") as f:
-        TX = pickle.load(f)
-    return TX
+    if "indptr" in graph:
+        # Already CSR: wrap the arrays without rebuilding them
+        indptr, indices = np.asarray(graph["indptr"]), np.asarray(graph["indices"])
+        num_nodes = indptr.size - 1
+        return sparse.csr_matrix(
+            (np.ones(indices.size, dtype=np.int8), indices, indptr), shape=(num_nodes, num_nodes)
+        )
+    sources, targets = graph_edges(graph)
+    num_nodes = int(max(sources.max(initial=-1), targets.max(initial=-1))) + 1
+    return sparse.csr_matrix(
+        (np.ones(sources.size, dtype=np.int8), (sources, targets)), shape=(num_nodes, num_nodes)
+    )
 
-def load_test_labels(data_dir):
+def graph_layout(G):
     """
-    Load testing labels from file ind.clout.ty.
+    Compute node positions for G. Uses Graphviz sfdp (refined with a few
+    spring_layout iterations) when pygraphviz is installed, then ForceAtlas2 when
+    fa2_modified is installed, and plain spring_layout otherwise.
     """
-    filename = "ind.clout.ty"
-    path = os.path.join(data_dir, filename)
-    with open(path, "rb") as f:
-        TY = pickle.load(f)
-    return TY
+    if graphviz_layout is not None:
+        pos = graphviz_layout(G, prog="sfdp", args="-Goverlap=scale")
+        return nx.spring_layout(G, pos=pos, iterations=20, seed=42)
+    if ForceAtlas2 is not None:
+        return ForceAtlas2(verbose=False).forceatlas2_networkx_layout(G, pos=None, iterations=200)
+    return nx.spring_layout(G, seed=42)
 
-def plot_graph(graph):
+def plot_graph(graph, graphml_path="clout_graph.graphml"):
     """
-    Convert the adjacency list into a NetworkX graph and visualize it.
+    Convert the graph adjacency into a NetworkX graph and visualize it.
+    Graphs larger than LARGE_GRAPH_NODES are also written to graphml_path (for
+    Gephi) and only their node positions are plotted.
     """
-    G = nx.Graph()
-    for source, targets in graph.items():
-        for target in targets:
-            G.add_edge(source, target)
+    G = nx.from_scipy_sparse_array(graph_adjacency(graph))
+    # Only nodes that take part in an edge are drawn
+    G.remove_nodes_from(list(nx.isolates(G)))
     
+    pos = graph_layout(G)
     plt.figure(figsize=(10, 10))
-    pos = nx.spring_layout(G, seed=42)
-    nx.draw(G, pos, with_labels=True, node_color="skyblue", edge_color="gray", node_size=500)
+    if G.number_of_nodes() > LARGE_GRAPH_NODES:
+        nx.write_graphml(G, graphml_path)
+        print(f"Graph has {G.number_of_nodes()} nodes; saved to {graphml_path}")
+        xs, ys = np.array(list(pos.values())).T
+        plt.scatter(xs, ys, s=1)
+    else:
+        nx.draw(G, pos, with_labels=True, node_color="skyblue", edge_color="gray", node_size=500)
     plt.title("Graph Structure")
     plt.show()
 
+def tsne_embedding(features, n_jobs=-1):
+    """
+    Return the 2-D t-SNE embedding of features, using openTSNE when installed
+    and scikit-learn otherwise. n_jobs is the number of threads it may use.
+    """
+    # Wide sparse matrices are projected with TruncatedSVD instead of being densified
+    if sparse.issparse(features):
+        if features.shape[1] > TSNE_SVD_COMPONENTS:
+            features = TruncatedSVD(n_components=TSNE_SVD_COMPONENTS, random_state=42).fit_transform(features)
+        else:
+            features = features.toarray()
+    if OpenTSNE is not None:
+        embedding = OpenTSNE(
+            n_components=2, n_jobs=n_jobs, negative_gradient_method='fft', random_state=42
+        ).fit(np.asarray(features, dtype=np.float64))
+        return np.asarray(embedding)
+    return TSNE(n_components=2, random_state=42, n_jobs=n_jobs).fit_transform(features)
+
 def plot_tsne_subplots(train_features, train_labels, test_features, test_labels):
     """
     Compute and visualize t-SNE on training and testing features in a 
     side-by-side subplot layout.
     """
-    # Convert sparse matrices to dense arrays if necessary
-    if sparse.issparse(train_features):
-        train_features = train_features.toarray()
-    if sparse.issparse(test_features):
-        test_features = test_features.toarray()
-    
-    # Perform t-SNE separately on training and testing features.
-    tsne_train = TSNE(n_components=2, random_state=42).fit_transform(train_features)
-    tsne_test = TSNE(n_components=2, random_state=42).fit_transform(test_features)
+    # Perform t-SNE separately on training and testing features, in two worker
+    # processes that each get half of the cores.
+    n_jobs = max(1, (os.cpu_count() or 2) // 2)
+    with ProcessPoolExecutor(max_workers=2) as executor:
+        train_future = executor.submit(tsne_embedding, train_features, n_jobs)
+        test_future = executor.submit(tsne_embedding, test_features, n_jobs)
+        tsne_train, tsne_test = train_future.result(), test_future.result()
     
     fig, axes = plt.subplots(1, 2, figsize=(14, 6))
     
@@ -109,30 +192,24 @@ def plot_tsne_subplots(train_features, train_labels, test_features, test_labels)
 def main():
     data_dir = "Dink-Net/data"
     
-    # Load graph data
-    print("Loading graph data...")
-    graph = load_graph(data_dir)
-    print(f"Graph loaded. Total nodes with outgoing edges: {len(graph)}")
+    # The five files are independent, so they are read concurrently
+    print("Loading graph data, training and testing features/labels...")
+    with ThreadPoolExecutor(max_workers=5) as executor:
+        graph_future = executor.submit(load_graph, data_dir)
+        futures = {name: executor.submit(load, data_dir, name) for name in ("x", "y", "tx", "ty")}
+        graph = graph_future.result()
+        X, Y, TX, TY = (futures[name].result() for name in ("x", "y", "tx", "ty"))
     
-    # Load training data
-    print("Loading training features...")
-    X = load_train_features(data_dir)
-    print("Training features loaded. Shape:", X.shape)
+    sources, _ = graph_edges(graph)
+    print(f"Graph loaded. Total nodes with outgoing edges: {np.unique(sources).size}")
     
-    print("Loading training labels...")
-    Y = load_train_labels(data_dir)
+    print("Training features loaded. Shape:", X.shape)
     if hasattr(Y, "shape"):
         print("Training labels loaded. Shape:", Y.shape)
     else:
         print("Training labels loaded. Total labels:", len(Y))
     
-    # Load testing data
-    print("Loading testing features...")
-    TX = load_test_features(data_dir)
     print("Testing features loaded. Shape:", TX.shape)
-    
-    print("Loading testing labels...")
-    TY = load_test_labels(data_dir)
     if hasattr(TY, "shape"):
         print("Testing labels loaded. Shape:", TY.shape)
     else: